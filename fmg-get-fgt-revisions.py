@@ -4,146 +4,398 @@ Author: Prithvi Mandava
 Date: 2025-03-03
 Description:
     This script connects to a FortiManager instance and retrieves configuration revisions
-    from all FortiGates in all ADOMs. It saves each configuration as a .conf file in 
-    directories organized by ADOM. The script supports filtering revisions from a 
+    from all FortiGates in all ADOMs. It saves each configuration as a gzip-compressed
+    .conf.gz file in directories organized by ADOM. The script supports filtering revisions from a 
     specific start date and securely loads the API key and settings from an external 
-    'config.env' file.
+    'config.env' file. Downloaded revisions are recorded in a manifest so that
+    later runs only fetch new revisions.
     
 Version: 1.1
 
 Requirements:
-    - Python 3.x
+    - Python 3.10+
     - requests library (`pip install requests`)
     - python-dotenv library (`pip install python-dotenv`)
+    - ijson library (`pip install ijson`)
+    - orjson library (`pip install orjson`)
     - Config file: `config.env` containing:
         FMG_API_KEY=your_actual_api_key_here
         FMG_IP=192.168.1.99
         ADOM_FILTER_DATE=2025-03-03
+        FMG_WORKERS=10  (optional, number of parallel API requests)
+        FMG_GZIP_LEVEL=6  (optional, 1-9 compression level of saved configs)
 """
 
+import asyncio
+import gzip
+import ijson
+import orjson
 import requests
-import json
 import os
+import re
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+from urllib3.util.retry import Retry
 
-# Load environment variables from config.env
-config_file = "config.env"
-load_dotenv(config_file)
+# Settings from config.env, validated once at startup
+@dataclass(frozen=True, slots=True)
+class Config:
+    url: str
+    headers: MappingProxyType = field(compare=False)
+    adom_filter_datetime: datetime
+    adom_filter_prefix: str
+    max_workers: int
+    gzip_level: int
 
-# Get variables from the environment
-api_key = os.getenv("FMG_API_KEY")
-fmg_ip = os.getenv("FMG_IP")
-adom_filter_date = os.getenv("ADOM_FILTER_DATE")
+# Load and validate the settings from the config file
+def load_config(config_file="config.env"):
+    load_dotenv(config_file)
 
-# Validate environment variables
-if not api_key:
-    print("Error: API key not found in the configuration file.")
-    exit(1)
+    # Get variables from the environment
+    api_key = os.getenv("FMG_API_KEY")
+    fmg_ip = os.getenv("FMG_IP")
+    adom_filter_date = os.getenv("ADOM_FILTER_DATE")
+    fmg_workers = os.getenv("FMG_WORKERS", "10")
+    fmg_gzip_level = os.getenv("FMG_GZIP_LEVEL", "6")
 
-if not fmg_ip:
-    print("Error: FortiManager IP address not found in the configuration file.")
-    exit(1)
+    # Validate environment variables
+    if not api_key:
+        print("Error: API key not found in the configuration file.")
+        sys.exit(1)
 
-if not adom_filter_date:
-    print("Error: ADOM filter date not found in the configuration file.")
-    exit(1)
+    if not fmg_ip:
+        print("Error: FortiManager IP address not found in the configuration file.")
+        sys.exit(1)
 
-# Parse the filter date
-try:
-    adom_filter_datetime = datetime.strptime(adom_filter_date, "%Y-%m-%d")
-    print(f"ADOM Filter Date: {adom_filter_date}")
-except ValueError:
-    print("Error: Invalid date format for ADOM_FILTER_DATE. Use YYYY-MM-DD format.")
-    exit(1)
+    if not adom_filter_date:
+        print("Error: ADOM filter date not found in the configuration file.")
+        sys.exit(1)
+
+    try:
+        max_workers = int(fmg_workers)
+        if max_workers < 1:
+            raise ValueError
+    except ValueError:
+        print("Error: FMG_WORKERS must be a positive integer.")
+        sys.exit(1)
+
+    try:
+        gzip_level = int(fmg_gzip_level)
+        if not 1 <= gzip_level <= 9:
+            raise ValueError
+    except ValueError:
+        print("Error: FMG_GZIP_LEVEL must be an integer from 1 to 9.")
+        sys.exit(1)
+
+    # Parse the filter date
+    try:
+        adom_filter_datetime = datetime.strptime(adom_filter_date, "%Y-%m-%d")
+        print(f"ADOM Filter Date: {adom_filter_date}")
+    except ValueError:
+        print("Error: Invalid date format for ADOM_FILTER_DATE. Use YYYY-MM-DD format.")
+        sys.exit(1)
+
+    return Config(
+        url=f"https://{fmg_ip}/jsonrpc",
+        headers=MappingProxyType({
+            "Content-Type": b"application/json",
+            "Authorization": f"Bearer {api_key}".encode()
+        }),
+        adom_filter_datetime=adom_filter_datetime,
+        # Revision "instime" values are zero-padded "YYYY-MM-DD HH:MM:SS" strings,
+        # which sort lexicographically in time order and compare to this directly
+        adom_filter_prefix=adom_filter_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+        max_workers=max_workers,
+        gzip_level=gzip_level
+    )
+
+config = load_config()
 
 # Output directory for config files (relative to the script's directory)
 script_dir = os.path.dirname(os.path.abspath(__file__))
 output_dir = os.path.join(script_dir, "config_revisions")
 
+# Manifest of already downloaded (ADOM, device, revision) entries. Revision
+# IDs are immutable, so these are skipped on later runs.
+manifest_file = os.path.join(output_dir, "manifest.json")
+manifest_flush_interval = 50
+manifest_lock = asyncio.Lock()
+
+# Translation table turning a revision "instime" into a filename-safe timestamp
+timestamp_trans = str.maketrans({":": "-", " ": "_"})
+
+# Limit API requests in flight against FortiManager to the worker pool size
+request_slots = asyncio.Semaphore(config.max_workers)
+
 # Disable SSL warnings (not recommended for production)
 requests.packages.urllib3.disable_warnings()
 
+# Shared session so every API call reuses a kept-alive TLS connection.
+# The pool holds one connection per worker thread. JSON-RPC calls are all
+# POSTs, so POST is allowed to be retried on transient FortiManager errors,
+# honouring any Retry-After header it sends.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_maxsize=config.max_workers,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+))
+
 # Function to send API requests to FortiManager using an API key
-def send_request(method, params):
-    url = f"https://{fmg_ip}/jsonrpc"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+async def send_request(method, params):
+    # requests is blocking, so run it in a worker thread and let the event
+    # loop keep other ADOMs/devices/revisions moving in the meantime
+    async with request_slots:
+        return await asyncio.to_thread(post_request, method, params)
+
+# Blocking JSON-RPC call, run off the event loop by send_request
+def post_request(method, params, cfg=config):
     payload = {
         "method": method,
         "params": params,
         "id": 1
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload), verify=False)
+    try:
+        response = session.post(cfg.url, data=orjson.dumps(payload), headers=cfg.headers, verify=False)
+    except requests.RequestException as e:
+        print(f"Request to FortiManager failed: {e}")
+        return None
 
     try:
-        response_data = response.json()
+        response_data = orjson.loads(response.content)
         if "result" in response_data:
             return response_data["result"]
         else:
             print(f"Error: No 'result' in response data: {response_data}")
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Failed to parse JSON response: {e}")
         print(f"Raw Response: {response.text}")
     
     return None
 
-# Get all ADOMs
-def get_adoms():
-    params = [{"url": "/dvmdb/adom"}]
-    result = send_request("get", params)
-    if result and "data" in result[0]:
-        return [adom["name"] for adom in result[0]["data"]]
-    print("No ADOM data found.")
-    return []
-
-# Get all devices in a given ADOM
-def get_devices(adom_name):
-    params = [{"url": f"/dvmdb/adom/{adom_name}/device"}]
-    result = send_request("get", params)
-    if result and "data" in result[0]:
-        devices = result[0]["data"]
-        print(f"Devices in ADOM '{adom_name}': {[device['name'] for device in devices]}")
-        return [device["name"] for device in devices]
-    
-    print(f"No devices found in ADOM: {adom_name}")
-    return []
+# Zero-padded "YYYY-MM-DD HH:MM:SS" timestamps that can be compared as strings
+instime_pattern = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}", re.ASCII)
+
+# Check that the "YYYY-MM-DD" date part of an instime is a real calendar date.
+# Every revision's date part goes through here, but a run only spans a few
+# distinct days, so nearly all calls are cache hits. The cache is bounded so
+# that input with many distinct dates cannot grow it without limit; 4096 entries
+# cover more than ten years of daily dates.
+@lru_cache(maxsize=4096)
+def is_valid_instime_date(date_part):
+    try:
+        datetime.strptime(date_part, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+# True if an instime is a valid zero-padded timestamp that can be compared as a
+# string. The time fields are range checked as strings with strptime's limits.
+def is_comparable_instime(instime):
+    return (instime_pattern.fullmatch(instime) is not None
+            and instime[11:13] <= "23" and instime[14:16] <= "59" and instime[17:19] <= "61"
+            and is_valid_instime_date(instime[:10]))
+
+# Parse an instime that is not a valid zero-padded timestamp, raising ValueError
+# if it is malformed
+def parse_instime(instime):
+    return datetime.strptime(instime, "%Y-%m-%d %H:%M:%S")
+
+# Blocking revision checkout. The response is streamed through an incremental
+# JSON parser; the config content is pulled out on its own and the rest of the
+# (small) response is rebuilt so FortiManager errors can still be reported.
+def post_checkout_request(params, cfg=config):
+    payload = {
+        "method": "exec",
+        "params": params,
+        "id": 1
+    }
+
+    try:
+        with session.post(cfg.url, data=orjson.dumps(payload), headers=cfg.headers, verify=False, stream=True) as response:
+            response.raw.decode_content = True
+            builder = ijson.ObjectBuilder()
+            config_data = None
+            try:
+                for prefix, event, value in ijson.parse(response.raw):
+                    if prefix == "result.item.data.content" and event == "string":
+                        config_data = value
+                    else:
+                        builder.event(event, value)
+            except ijson.JSONError as e:
+                print(f"Failed to parse JSON response: {e}")
+                return None
+    except (requests.RequestException, HTTPError) as e:
+        print(f"Request to FortiManager failed: {e}")
+        return None
+
+    if config_data is not None:
+        return config_data
+
+    response_data = getattr(builder, "value", None)
+    if not isinstance(response_data, dict) or "result" not in response_data:
+        print(f"Error: No 'result' in response data: {response_data}")
+    elif response_data["result"]:
+        entry = response_data["result"][0]
+        if "data" in entry:
+            print(f"Error: 'content' key not found in the response data: {entry['data']}")
+        if "status" in entry:
+            print(f"Error: FortiManager returned status: {entry['status']}")
+    return None
 
-# Get configuration revisions using the correct API method
-def get_config_revisions(adom_name, device_name):
+# Load the set of already downloaded (ADOM, device, revision) entries
+def load_manifest():
+    try:
+        with open(manifest_file, "rb") as f:
+            entries = orjson.loads(f.read())
+    except FileNotFoundError:
+        return set()
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read manifest {manifest_file}, downloading all revisions: {e}")
+        return set()
+
+    if not isinstance(entries, list):
+        print(f"Warning: Manifest {manifest_file} is not a list, downloading all revisions.")
+        return set()
+
+    # Keep only [adom, device, revision] entries and drop anything else
+    downloaded = set()
+    for entry in entries:
+        if (isinstance(entry, list) and len(entry) == 3
+                and isinstance(entry[0], str) and isinstance(entry[1], str)
+                and isinstance(entry[2], int) and not isinstance(entry[2], bool)):
+            downloaded.add(tuple(entry))
+        else:
+            print(f"Warning: Ignoring malformed manifest entry: {entry!r}")
+    return downloaded
+
+# Save the set of downloaded entries, replacing the manifest atomically
+def save_manifest(downloaded):
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(sorted(downloaded, key=repr)))
+    os.replace(tmp_file, manifest_file)
+
+# Save a snapshot of the downloaded entries in a worker thread, one save at a time
+async def flush_manifest(downloaded):
+    async with manifest_lock:
+        await asyncio.to_thread(save_manifest, frozenset(downloaded))
+
+# Get all ADOMs and the global device list in a single batched API call.
+# Returns the ADOM names and the device names grouped by ADOM, or None in place
+# of the grouping if the device records do not say which ADOM they belong to.
+async def get_adoms_and_devices():
+    params = [
+        {"url": "/dvmdb/adom", "fields": ["name"]},
+        {"url": "/dvmdb/device", "fields": ["name", "adom"]}
+    ]
+    result = await send_request("get", params) or []
+    adom_entry, device_entry = (result + [{}, {}])[:2]
+
+    if "data" not in adom_entry:
+        print("No ADOM data found.")
+        return [], {}
+    adom_names = [adom["name"] for adom in adom_entry["data"]]
+
+    devices = device_entry.get("data")
+    if devices is None or not all("adom" in device for device in devices):
+        return adom_names, None
+
+    devices_by_adom = defaultdict(list)
+    for device in devices:
+        devices_by_adom[device["adom"]].append(device["name"])
+    for adom_name in adom_names:
+        if devices_by_adom[adom_name]:
+            print(f"Devices in ADOM '{adom_name}': {devices_by_adom[adom_name]}")
+        else:
+            print(f"No devices found in ADOM: {adom_name}")
+    return adom_names, dict(devices_by_adom)
+
+# Get the devices of all given ADOMs in a single batched API call
+async def get_devices(adom_names):
+    if not adom_names:
+        return {}
+    params = [{"url": f"/dvmdb/adom/{adom_name}/device"} for adom_name in adom_names]
+    result = await send_request("get", params) or []
+
+    # The result list is in the same order as the params list
+    devices_by_adom = {}
+    for i, adom_name in enumerate(adom_names):
+        entry = result[i] if i < len(result) else {}
+        if "data" in entry:
+            devices = entry["data"]
+            print(f"Devices in ADOM '{adom_name}': {[device['name'] for device in devices]}")
+            devices_by_adom[adom_name] = [device["name"] for device in devices]
+        else:
+            print(f"No devices found in ADOM: {adom_name}")
+            devices_by_adom[adom_name] = []
+    return devices_by_adom
+
+# Get configuration revisions of all given devices in an ADOM in a single batched API call
+async def get_config_revisions(adom_name, device_names, cfg=config):
+    if not device_names:
+        return {}
     params = [{
         "url": "/deployment/get/device/revision",
         "data": {
             "adom": adom_name,
             "device": device_name
         }
-    }]
-    result = send_request("exec", params)
-    
-    if result and "data" in result[0]:
-        revisions = result[0]["data"]
-        if "revinfo" in revisions and isinstance(revisions["revinfo"], list):
-            filtered_revisions = []
-            for rev in revisions["revinfo"]:
-                if "instime" in rev:
+    } for device_name in device_names]
+    result = await send_request("exec", params) or []
+
+    # The result list is in the same order as the params list
+    revisions_by_device = {}
+    for i, device_name in enumerate(device_names):
+        entry = result[i] if i < len(result) else {}
+        revisions_by_device[device_name] = []
+        if "data" in entry:
+            revisions = entry["data"]
+            if "revinfo" in revisions and isinstance(revisions["revinfo"], list):
+                filtered_revisions = []
+                for rev in revisions["revinfo"]:
+                    if "instime" not in rev:
+                        continue
+                    instime = rev["instime"]
+                    if is_comparable_instime(instime):
+                        if instime >= cfg.adom_filter_prefix:
+                            filtered_revisions.append(rev)
+                        continue
                     try:
-                        rev_date = datetime.strptime(rev["instime"], "%Y-%m-%d %H:%M:%S")
-                        if rev_date >= adom_filter_datetime:
+                        if parse_instime(instime) >= cfg.adom_filter_datetime:
                             filtered_revisions.append(rev)
                     except ValueError as e:
                         print(f"Date parsing error for revision: {rev} | Error: {e}")
-            return filtered_revisions
-        else:
-            print(f"Unexpected 'revinfo' format or missing 'revinfo' key in revisions data.")
-    
-    print(f"No revision data found for device: {device_name} in ADOM: {adom_name}")
-    return []
+                revisions_by_device[device_name] = filtered_revisions
+                continue
+            else:
+                print(f"Unexpected 'revinfo' format or missing 'revinfo' key in revisions data.")
+
+        print(f"No revision data found for device: {device_name} in ADOM: {adom_name}")
+    return revisions_by_device
+
+# Write a gzip-compressed configuration file to disk
+def write_config(file_path, config_data, cfg=config):
+    with gzip.open(file_path, "wt", compresslevel=cfg.gzip_level) as f:
+        f.write(config_data)
 
 # Download the configuration for a specific revision
-def download_config(adom_name, device_name, revision_id, timestamp):
+async def download_config(adom_name, device_name, revision_id, timestamp, downloaded):
     params = [{
         "url": "/deployment/checkout/revision",
         "data": {
@@ -152,44 +404,67 @@ def download_config(adom_name, device_name, revision_id, timestamp):
             "revision": revision_id
         }
     }]
-    result = send_request("exec", params)
+    async with request_slots:
+        config_data = await asyncio.to_thread(post_checkout_request, params)
     
-    if result and "data" in result[0]:
-        data = result[0]["data"]
-        if "content" in data:
-            config_data = data["content"]
-            
-            adom_dir = os.path.join(output_dir, adom_name)
-            os.makedirs(adom_dir, exist_ok=True)
-            
-            filename = f"{device_name}_{timestamp}.conf"
-            file_path = os.path.join(adom_dir, filename)
-            
-            with open(file_path, "w") as f:
-                f.write(config_data)
-            print(f"Configuration saved to {file_path}")
-        else:
-            print(f"Error: 'content' key not found in the response data: {data}")
+    if config_data is not None:
+        filename = f"{device_name}_{timestamp}.conf.gz"
+        file_path = os.path.join(output_dir, adom_name, filename)
+        
+        # Write in a worker thread so the event loop keeps issuing requests
+        await asyncio.to_thread(write_config, file_path, config_data)
+        print(f"Configuration saved to {file_path}")
+
+        downloaded.add((adom_name, device_name, revision_id))
+        if len(downloaded) % manifest_flush_interval == 0:
+            await flush_manifest(downloaded)
     else:
         print(f"Failed to download configuration for device {device_name}, revision {revision_id}")
 
+# Download every filtered revision of all devices in a single ADOM concurrently
+async def process_adom(adom_name, device_names, downloaded):
+    revisions_by_device = await get_config_revisions(adom_name, device_names)
+    all_revisions = []
+    downloads = []
+    skipped = 0
+    for device_name, revisions in revisions_by_device.items():
+        all_revisions.extend(revisions)
+        for rev in revisions:
+            revision_id = rev["revision"]
+            if (adom_name, device_name, revision_id) in downloaded:
+                skipped += 1
+                continue
+            timestamp = rev["instime"].translate(timestamp_trans)
+            downloads.append(download_config(adom_name, device_name, revision_id, timestamp, downloaded))
+    if skipped:
+        print(f"Skipping {skipped} already downloaded revision(s) in ADOM: {adom_name}")
+    await asyncio.gather(*downloads)
+    return all_revisions
+
 # Main function
-def main():
+async def main():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=config.max_workers))
     all_revisions = []
-    adoms = get_adoms()
-    for adom_name in adoms:
-        devices = get_devices(adom_name)
-        for device_name in devices:
-            revisions = get_config_revisions(adom_name, device_name)
-            if revisions:
-                all_revisions.extend(revisions)
-                for rev in revisions:
-                    revision_id = rev["revision"]
-                    timestamp = rev["instime"].replace(":", "-").replace(" ", "_")
-                    download_config(adom_name, device_name, revision_id, timestamp)
+    downloaded = load_manifest()
+    adoms, devices_by_adom = await get_adoms_and_devices()
+    if devices_by_adom is None:
+        print("Global device list has no ADOM information, listing devices per ADOM instead.")
+        devices_by_adom = await get_devices(adoms)
+
+    # Create the output directory of every ADOM with devices up front
+    for adom_name, device_names in devices_by_adom.items():
+        if device_names:
+            os.makedirs(os.path.join(output_dir, adom_name), exist_ok=True)
+
+    try:
+        results = await asyncio.gather(*(process_adom(adom_name, device_names, downloaded) for adom_name, device_names in devices_by_adom.items()))
+    finally:
+        await flush_manifest(downloaded)
+    for revisions in results:
+        all_revisions.extend(revisions)
     
     if not all_revisions:
         print("No revisions found for the specified date.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file